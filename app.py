@@ -1,201 +1,503 @@
-from flask import Flask, request, jsonify, render_template, Response
-from pymongo import MongoClient, errors as pymongo_errors
-from datetime import datetime
+from flask import Blueprint, Flask, request, render_template, Response, stream_with_context
+from flask_caching import Cache
+from flask_compress import Compress
+from pymongo import MongoClient, WriteConcern, errors as pymongo_errors
+from datetime import datetime, timezone
 import os
-import io
 import csv
+import hashlib
+import hmac
+import itertools
 import logging
+import threading
+import time
+import zlib
+import orjson
 
 # Basic logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__, template_folder="templates")
+# Extensions and routes are bound to the app in create_app()
+bp = Blueprint("main", __name__)
+# Every route on admin_bp requires the admin key (see _require_admin_key)
+admin_bp = Blueprint("admin", __name__, url_prefix="/admin")
+
+# In-process cache for hot, read-mostly endpoints. SimpleCache is per worker:
+# a submit only invalidates its own worker's entry, so other workers may serve
+# counts up to 15 s stale.
+cache = Cache()
+# Fixed key used both to cache /api/counts and to invalidate it on submit
+COUNTS_CACHE_KEY = "api_counts"
+
+compress = Compress()
+
+
+def _jsonify(payload):
+    """Like flask.jsonify but encoded with orjson (datetimes serialized natively)."""
+    return Response(orjson.dumps(payload, option=orjson.OPT_NAIVE_UTC), mimetype="application/json")
+
 
 # --- CONFIGURE MONGODB (read from env) ---
 MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.environ.get("MONGO_DB", "petition_db")
-
-# Connect with a short server selection timeout so failures are visible quickly
-try:
-    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+# Key of the created_at index; also used as sort spec and hint for record reads
+CREATED_AT_DESC = [("created_at", -1)]
+CREATED_AT_INDEX = "created_at_-1"
+FORM_TYPE_INDEX = "form_type_1"
+
+# Connection pool sizing. Each gunicorn worker process gets its own MongoClient,
+# so a worker only needs as many sockets as requests it serves concurrently
+# (its thread count) plus a small buffer for health checks / bursts.
+# Total sockets opened against the cluster is roughly workers x MONGO_MAX_POOL_SIZE;
+# keep that well below the Atlas tier connection limit (e.g. 500 on M0/M2/M5).
+GUNICORN_THREADS = int(os.environ.get("GUNICORN_THREADS", 1))
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", max(GUNICORN_THREADS + 4, 20)))
+
+# MongoClient is not fork-safe, so it is never created at import time (under
+# `gunicorn --preload` that would share one pool across forked workers).
+# Each worker process connects on first use and keeps its own pool.
+_collection = None
+_submit_collection = None
+# Names of the indexes present after _connect(); hints are only passed for these
+_index_names = frozenset()
+_client_pid = None
+_db_lock = threading.Lock()
+# After a failed connect, skip reconnect attempts for this long so an outage
+# returns 503 immediately instead of stalling every request on server selection
+DB_RETRY_BACKOFF_S = 10
+_last_connect_failure = None
+
+
+def _connect():
+    global _index_names, _collection, _submit_collection, _client_pid
+
+    # Short server selection timeout so failures are visible quickly
+    client = MongoClient(
+        MONGO_URI,
+        serverSelectionTimeoutMS=5000,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=2,
+        maxIdleTimeMS=60000,
+        waitQueueTimeoutMS=2500,
+        retryWrites=True,
+    )
     # attempt an info call to trigger immediate connection check
     client.admin.command("ping")
-    db = client[DB_NAME]
-    collection = db["students"]
-    logger.info("Connected to MongoDB database '%s'.", DB_NAME)
-except pymongo_errors.PyMongoError as e:
-    # If connection fails, log and set collection to None so endpoints can return 503
-    logger.exception("Failed to connect to MongoDB: %s", e)
-    client = None
-    db = None
-    collection = None
+    collection = client[DB_NAME]["students"]
+    logger.info("Connected to MongoDB database '%s' (pid %s).", DB_NAME, os.getpid())
+    try:
+        # created_at serves sorted reads; form_type serves counts; the compound
+        # index covers "records of type X, newest first". No-ops if they exist.
+        collection.create_index(CREATED_AT_DESC, background=True)
+        collection.create_index("form_type", background=True)
+        collection.create_index([("form_type", 1), ("created_at", -1)], background=True)
+    except pymongo_errors.PyMongoError as e:
+        logger.warning("Could not create indexes: %s", e)
+    try:
+        index_names = frozenset(collection.index_information())
+    except pymongo_errors.PyMongoError as e:
+        logger.warning("Could not list indexes, query hints disabled: %s", e)
+        index_names = frozenset()
+
+    _index_names = index_names
+    _collection = collection
+    # Submissions are low-stakes: acknowledge from the primary only (w=1)
+    # instead of waiting for a majority of the replica set.
+    _submit_collection = collection.with_options(write_concern=WriteConcern(w=1))
+    _client_pid = os.getpid()
+
+
+def get_collection():
+    """Return this process's students collection, connecting on first use.
+
+    Returns None if MongoDB is unreachable or a connect failed within the
+    last DB_RETRY_BACKOFF_S seconds (so callers fail fast with 503).
+    """
+    global _last_connect_failure
+
+    if _collection is not None and _client_pid == os.getpid():
+        return _collection
+    if _last_connect_failure is not None and time.monotonic() - _last_connect_failure < DB_RETRY_BACKOFF_S:
+        return None
+    # Threads arriving during a connect wait for its outcome rather than 503ing
+    with _db_lock:
+        if _collection is not None and _client_pid == os.getpid():
+            return _collection
+        if _last_connect_failure is not None and time.monotonic() - _last_connect_failure < DB_RETRY_BACKOFF_S:
+            return None
+        try:
+            _connect()
+            _last_connect_failure = None
+        except pymongo_errors.PyMongoError as e:
+            # Log and leave collection unset so endpoints can return 503
+            logger.exception("Failed to connect to MongoDB: %s", e)
+            _last_connect_failure = time.monotonic()
+            return None
+        return _collection
+
+
+def get_submit_collection():
+    """Like get_collection(), but with the w=1 write concern used for submissions."""
+    if get_collection() is None:
+        return None
+    return _submit_collection
+
+
+# --- Cursor tuning ---
+# Fixed batch size keeps per-getMore memory predictable; records API is capped
+CURSOR_BATCH_SIZE = 500
+RECORDS_MAX_LIMIT = 1000
+# Only the fields the endpoints render (_id is always returned)
+RECORD_PROJECTION = {"afn": 1, "year": 1, "branch": 1, "comment": 1, "form_type": 1, "created_at": 1}
 
 # --- ADMIN KEY (for CSV export) ---
 ADMIN_KEY = os.environ.get("ADMIN_KEY", None)
+_ADMIN_KEY_B = ADMIN_KEY.encode() if ADMIN_KEY else None
 #____health____
-@app.route("/health", methods=["GET"])
+@bp.route("/health", methods=["GET"])
 def health_check():
     """Return DB connection status and exception if any."""
     info = {"db_connected": False, "db_name": DB_NAME}
     try:
-        if client is None:
-            info["error"] = "Mongo client is None (connection failure during startup)"
-            return jsonify(info), 503
-        client.admin.command("ping")
+        collection = get_collection()
+        if collection is None:
+            info["error"] = "Mongo client is None (connection failure)"
+            return _jsonify(info), 503
+        collection.database.client.admin.command("ping")
         info["db_connected"] = True
-        return jsonify(info)
+        return _jsonify(info)
     except Exception as e:
         info["error"] = str(e)
-        return jsonify(info), 503
+        return _jsonify(info), 503
         
 # --- ROUTES serving pages ---
-@app.route("/")
+# Pages have no per-request data, so create_app() renders them once and they
+# are served as cached bytes with an ETag (304 when the client already has them).
+PAGE_TEMPLATES = ("index.html", "petition.html", "demand.html")
+_PAGES = {}
+
+
+def _prerender(app, template_name):
+    # url_for needs a request context to build the static URLs
+    with app.test_request_context("/"):
+        body = render_template(template_name).encode()
+    return body, hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def _serve_page(template_name):
+    body, etag = _PAGES[template_name]
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, mimetype="text/html")
+    resp.set_etag(etag)
+    return resp
+
+
+@bp.route("/")
 def index():
-    return render_template("index.html")
+    return _serve_page("index.html")
 
 
-@app.route("/petition")
+@bp.route("/petition")
 def petition_page():
-    return render_template("petition.html")
+    return _serve_page("petition.html")
 
 
-@app.route("/demand")
+@bp.route("/demand")
 def demand_page():
-    return render_template("demand.html")
+    return _serve_page("demand.html")
 
 
-# --- Helper: check DB availability ---
-def _db_available():
-    if collection is None:
-        return False
-    return True
+def _now():
+    """Timezone-aware UTC now (datetime.utcnow is deprecated)."""
+    return datetime.now(timezone.utc)
 
 
 # --- API endpoints ---
-@app.route("/api/submit", methods=["POST"])
+REQUIRED_FIELDS = ("afn", "year", "branch", "comment", "form_type")
+
+
+@bp.route("/api/submit", methods=["POST"])
 def api_submit():
-    if not _db_available():
-        return jsonify({"success": False, "error": "Database unavailable"}), 503
+    submit_collection = get_submit_collection()
+    if submit_collection is None:
+        return _jsonify({"success": False, "error": "Database unavailable"}), 503
 
     try:
         data = request.get_json(force=True)
     except Exception:
-        return jsonify({"success": False, "error": "Invalid JSON body"}), 400
-
-    required = ["afn", "year", "branch", "comment", "form_type"]
-    for r in required:
-        if r not in data or not str(data[r]).strip():
-            return jsonify({"success": False, "error": f"Missing or empty field: {r}"}), 400
-
-    entry = {
-        "afn": str(data["afn"]).strip(),
-        "year": str(data["year"]).strip(),
-        "branch": str(data["branch"]).strip(),
-        "comment": str(data["comment"]).strip(),
-        "form_type": str(data["form_type"]).strip(),
-        "created_at": datetime.utcnow()
-    }
+        return _jsonify({"success": False, "error": "Invalid JSON body"}), 400
+
+    if not isinstance(data, dict):
+        return _jsonify({"success": False, "error": "Invalid JSON body"}), 400
 
+    # Single pass: stringify/strip each value once, fail fast on missing or empty
     try:
-        result = collection.insert_one(entry)
-        entry["_id"] = str(result.inserted_id)
-        return jsonify({"success": True, "entry": entry}), 201
+        vals = {k: str(data[k]).strip() for k in REQUIRED_FIELDS}
+    except KeyError as e:
+        return _jsonify({"success": False, "error": f"Missing field: {e.args[0]}"}), 400
+    missing = next((k for k, v in vals.items() if not v), None)
+    if missing:
+        return _jsonify({"success": False, "error": f"Empty field: {missing}"}), 400
+
+    entry = {**vals, "created_at": _now()}
+
+    try:
+        result = submit_collection.insert_one(entry)
+        # Drop this worker's cached counts; other workers catch up within the timeout
+        cache.delete(COUNTS_CACHE_KEY)
+        return _jsonify({"success": True, "id": str(result.inserted_id)}), 201
     except pymongo_errors.PyMongoError as e:
         logger.exception("DB insert failed: %s", e)
-        return jsonify({"success": False, "error": "Database insert failed"}), 500
+        return _jsonify({"success": False, "error": "Database insert failed"}), 500
+
+
+def _newest_first_cursor(collection):
+    """Batched, projected cursor over all records, newest first.
+
+    When the created_at index exists the hint pins the plan to it, so the sort
+    is always an index walk and never an in-memory sort bounded by the 100 MB
+    limit. Hinting a missing index would fail every read, so it is skipped then.
+    """
+    cursor = collection.find({}, projection=RECORD_PROJECTION, batch_size=CURSOR_BATCH_SIZE).sort(CREATED_AT_DESC)
+    if CREATED_AT_INDEX in _index_names:
+        cursor = cursor.hint(CREATED_AT_DESC)
+    return cursor
+
+
+def _record_to_dict(d):
+    """Shape a stored document for the records APIs."""
+    return {
+        "_id": str(d.get("_id")),
+        "afn": d.get("afn"),
+        "year": d.get("year"),
+        "branch": d.get("branch"),
+        "comment": d.get("comment"),
+        "form_type": d.get("form_type"),
+        "created_at": d.get("created_at")
+    }
 
 
-@app.route("/api/records", methods=["GET"])
+@bp.route("/api/records", methods=["GET"])
 def api_records():
-    if not _db_available():
-        return jsonify({"success": False, "error": "Database unavailable"}), 503
+    collection = get_collection()
+    if collection is None:
+        return _jsonify({"success": False, "error": "Database unavailable"}), 503
+
+    try:
+        limit = int(request.args.get("limit", RECORDS_MAX_LIMIT))
+        skip = int(request.args.get("skip", 0))
+    except ValueError:
+        return _jsonify({"success": False, "error": "limit and skip must be integers"}), 400
+    # limit=0 means "no limit" to MongoDB, so always clamp into 1..RECORDS_MAX_LIMIT
+    limit = min(max(limit, 1), RECORDS_MAX_LIMIT)
+    skip = max(skip, 0)
 
     try:
         docs = []
-        for d in collection.find().sort("created_at", -1):
-            docs.append({
-                "_id": str(d.get("_id")),
-                "afn": d.get("afn"),
-                "year": d.get("year"),
-                "branch": d.get("branch"),
-                "comment": d.get("comment"),
-                "form_type": d.get("form_type"),
-                "created_at": d.get("created_at").isoformat() if d.get("created_at") else None
-            })
-        return jsonify({"success": True, "records": docs})
+        cursor = _newest_first_cursor(collection).skip(skip).limit(limit)
+        for d in cursor:
+            docs.append(_record_to_dict(d))
+        return _jsonify({"success": True, "records": docs})
     except pymongo_errors.PyMongoError as e:
         logger.exception("DB read failed: %s", e)
-        return jsonify({"success": False, "error": "Database read failed"}), 500
+        return _jsonify({"success": False, "error": "Database read failed"}), 500
+
+
+@bp.route("/api/records.ndjson", methods=["GET"])
+def api_records_ndjson():
+    """Stream every record as newline-delimited JSON, newest first."""
+    collection = get_collection()
+    if collection is None:
+        return _jsonify({"success": False, "error": "Database unavailable"}), 503
+
+    try:
+        cursor = _newest_first_cursor(collection)
+        # find() is lazy: pull the first document now so query errors still
+        # produce a JSON 500 instead of an empty 200 stream
+        first = next(cursor, None)
+    except pymongo_errors.PyMongoError as e:
+        logger.exception("DB read failed for NDJSON stream: %s", e)
+        return _jsonify({"success": False, "error": "Database read failed"}), 500
+
+    def generate():
+        if first is None:
+            return
+
+        try:
+            for d in itertools.chain((first,), cursor):
+                yield orjson.dumps(_record_to_dict(d), option=orjson.OPT_NAIVE_UTC) + b"\n"
+        except pymongo_errors.PyMongoError as e:
+            # Headers are already sent; log and end the stream early
+            logger.exception("DB read failed during NDJSON stream: %s", e)
+
+    return _streaming_response(generate(), "application/x-ndjson")
+
+
+def _accepts_gzip():
+    return "gzip" in request.accept_encodings
+
+
+def _gzip_stream(chunks, header_chunks=0, flush_every=CURSOR_BATCH_SIZE):
+    """Gzip-encode an iterable of str/bytes chunks without buffering the whole body.
+
+    The leading header_chunks, the first data chunk and every flush_every-th
+    data chunk after it are sync-flushed, so the client receives the first row
+    immediately instead of once zlib's internal buffer fills.
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for i, chunk in enumerate(chunks):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk)
+        row = i - header_chunks
+        if row <= 0 or row % flush_every == 0:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _streaming_response(chunks, mimetype, headers=None, header_chunks=0):
+    """Wrap a generator in a streamed Response, gzipped when the client accepts it.
+
+    header_chunks is how many leading chunks precede the data rows (e.g. a CSV
+    header), so the gzip stream can flush the first row as soon as it exists.
+    """
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    if _accepts_gzip():
+        chunks = _gzip_stream(chunks, header_chunks=header_chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+
+def _is_success_response(rv):
+    """Only cache plain responses; error paths return (body, status) tuples."""
+    return not isinstance(rv, tuple)
 
 
-@app.route("/api/counts", methods=["GET"])
+@bp.route("/api/counts", methods=["GET"])
+@cache.cached(timeout=15, key_prefix=COUNTS_CACHE_KEY, response_filter=_is_success_response)
 def api_counts():
-    if not _db_available():
-        return jsonify({"success": False, "error": "Database unavailable"}), 503
+    collection = get_collection()
+    if collection is None:
+        return _jsonify({"success": False, "error": "Database unavailable"}), 503
 
     try:
-        total = collection.count_documents({})
-        petitions = collection.count_documents({"form_type": "petition"})
-        demands = collection.count_documents({"form_type": "demand"})
-        return jsonify({"success": True, "total": total, "petitions": petitions, "demands": demands})
+        # One $group pass instead of three separate count queries
+        pipeline = [{"$group": {"_id": "$form_type", "c": {"$sum": 1}}}]
+        agg_options = {"hint": FORM_TYPE_INDEX} if FORM_TYPE_INDEX in _index_names else {}
+        agg = collection.aggregate(pipeline, allowDiskUse=True, **agg_options)
+        counts = {d["_id"]: d["c"] for d in agg}
+        petitions = counts.get("petition", 0)
+        demands = counts.get("demand", 0)
+        # Exact and free: every document falls into exactly one $group bucket
+        total = sum(counts.values())
+        return _jsonify({"success": True, "total": total, "petitions": petitions, "demands": demands})
     except pymongo_errors.PyMongoError as e:
         logger.exception("DB count failed: %s", e)
-        return jsonify({"success": False, "error": "Database count failed"}), 500
+        return _jsonify({"success": False, "error": "Database count failed"}), 500
 
 
 # --- ADMIN CSV EXPORT ENDPOINT ---
+# Precomputed per-row helpers for the export loop. Fields are read with
+# dict.get so older documents missing a field still export (as blanks).
+_CSV_FIELDS = ("_id", "afn", "year", "branch", "form_type", "comment", "created_at")
+_COMMENT_TRANS = str.maketrans({"\r": " ", "\n": " \\n "})
+
+
 def _check_admin_key():
-    if ADMIN_KEY is None:
+    if _ADMIN_KEY_B is None:
         return False
 
-    header_key = request.headers.get("X-ADMIN-KEY")
-    if header_key and header_key == ADMIN_KEY:
-        return True
-
-    param_key = request.args.get("admin_key")
-    if param_key and param_key == ADMIN_KEY:
-        return True
+    key = request.headers.get("X-ADMIN-KEY") or request.args.get("admin_key")
+    if not key:
+        return False
 
-    return False
+    return hmac.compare_digest(key.encode(), _ADMIN_KEY_B)
 
 
-@app.route("/admin/export.csv", methods=["GET"])
-def admin_export_csv():
+@admin_bp.before_request
+def _require_admin_key():
+    # Bare 401 with no body: cheap to produce for unauthenticated scanner traffic
     if not _check_admin_key():
-        return jsonify({"success": False, "error": "Unauthorized"}), 401
+        return Response(status=401, headers={"WWW-Authenticate": 'ApiKey header="X-ADMIN-KEY"'})
 
-    if not _db_available():
-        return jsonify({"success": False, "error": "Database unavailable"}), 503
+
+@admin_bp.route("/export.csv", methods=["GET"])
+def admin_export_csv():
+    collection = get_collection()
+    if collection is None:
+        return _jsonify({"success": False, "error": "Database unavailable"}), 503
 
     try:
-        cursor = collection.find().sort("created_at", -1)
+        cursor = _newest_first_cursor(collection)
+        # find() is lazy: pull the first document now so query errors still
+        # produce a JSON 500 instead of failing after the 200 has been sent
+        first = next(cursor, None)
     except pymongo_errors.PyMongoError as e:
         logger.exception("DB read failed for CSV export: %s", e)
-        return jsonify({"success": False, "error": "Database read failed"}), 500
-
-    # Build CSV in-memory
-    output = io.StringIO()
-    writer = csv.writer(output)
-
-    writer.writerow(["id", "afn", "year", "branch", "form_type", "comment", "created_at_utc_iso"])
-
-    for doc in cursor:
-        _id = str(doc.get("_id"))
-        afn = doc.get("afn", "")
-        year = doc.get("year", "")
-        branch = doc.get("branch", "")
-        form_type = doc.get("form_type", "")
-        comment = doc.get("comment", "").replace("\r", " ").replace("\n", " \\n ")
-        created_at = doc.get("created_at").isoformat() if doc.get("created_at") else ""
-        writer.writerow([_id, afn, year, branch, form_type, comment, created_at])
-
-    csv_data = output.getvalue()
-    output.close()
-
-    resp = Response(csv_data, mimetype="text/csv")
-    resp.headers["Content-Disposition"] = "attachment; filename=petition_records.csv"
-    return resp
+        return _jsonify({"success": False, "error": "Database read failed"}), 500
+
+    # Stream CSV row by row instead of building it in-memory
+    class Echo:
+        """File-like proxy so csv.writer returns each encoded line."""
+        def write(self, value):
+            return value
+
+    def generate():
+        writer = csv.writer(Echo())
+        yield writer.writerow(["id", "afn", "year", "branch", "form_type", "comment", "created_at_utc_iso"])
+
+        if first is None:
+            return
+
+        try:
+            for doc in itertools.chain((first,), cursor):
+                _id, afn, year, branch, form_type, comment, created_at = map(doc.get, _CSV_FIELDS)
+                yield writer.writerow((
+                    str(_id), afn or "", year or "", branch or "", form_type or "",
+                    (comment or "").translate(_COMMENT_TRANS),
+                    created_at.isoformat() if created_at else "",
+                ))
+        except pymongo_errors.PyMongoError as e:
+            # Headers are already sent; log and end the stream early
+            logger.exception("DB read failed during CSV stream: %s", e)
+
+    return _streaming_response(
+        generate(),
+        "text/csv",
+        headers={"Content-Disposition": "attachment; filename=petition_records.csv"},
+        header_chunks=1,
+    )
+
+
+def create_app():
+    """Build the Flask app. No database connection is opened here."""
+    app = Flask(__name__, template_folder="templates")
+
+    cache.init_app(app, config={"CACHE_TYPE": "SimpleCache"})
+
+    # Transparent compression for buffered responses. Streamed responses (CSV,
+    # NDJSON) are excluded here (Flask-Compress would otherwise buffer or
+    # re-chunk them) and gzip-encoded incrementally via _gzip_stream.
+    app.config["COMPRESS_MIMETYPES"] = ["application/json", "text/html"]
+    app.config["COMPRESS_MIN_SIZE"] = 500
+    app.config["COMPRESS_STREAMS"] = False
+    compress.init_app(app)
+
+    app.register_blueprint(bp)
+    app.register_blueprint(admin_bp)
+
+    _PAGES.update({name: _prerender(app, name) for name in PAGE_TEMPLATES})
+    return app
+
+
+# Module-level app for `gunicorn app:app`
+app = create_app()
 
 
 if __name__ == "__main__":